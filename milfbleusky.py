@@ -1,9 +1,15 @@
-from atproto import Client
+from atproto import Client, models
+from atproto_client.exceptions import InvokeTimeoutError, NetworkError, RequestException
+import heapq
 import os
+import random
 import re
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict, Set, Tuple
+from functools import lru_cache
+from typing import Optional, List, Dict, Set, Tuple, Iterator, TextIO, NamedTuple
 
 # ================== CONFIG VIA ENV ==================
 
@@ -15,62 +21,154 @@ REPOST_LOG_FILE = os.getenv("REPOST_LOG_FILE", "reposted.txt")
 FOLLOW_ON_REPOST = os.getenv("FOLLOW_ON_REPOST", "0") == "1"
 
 LIST_MEMBER_LIMIT = int(os.getenv("LIST_MEMBER_LIMIT", "200"))
-AUTHOR_POSTS_PER_MEMBER = int(os.getenv("AUTHOR_POSTS_PER_MEMBER", "50"))
 FEED_MAX_ITEMS = int(os.getenv("FEED_MAX_ITEMS", "1000"))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "10"))
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
 
 # ================== HELPERS ==================
 
+class Candidate(NamedTuple):
+    created: datetime
+    uri: str
+    cid: str
+    author: Optional[str]
+
 def log(msg: str):
     now = datetime.now(timezone.utc).strftime("%H:%M:%S")
     print(f"[{now}] {msg}")
 
-def parse_time(record, post) -> Optional[datetime]:
-    for attr in ["createdAt", "indexedAt", "created_at", "timestamp"]:
-        val = getattr(record, attr, None) or getattr(post, attr, None)
+def now_z() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def retry_delay(e: Exception, attempt: int, server_errors: bool) -> Optional[float]:
+    """Seconds to wait before retrying after e, or None when it is not worth retrying."""
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        # timeouts / connection errors carry no response
+        if not server_errors:
+            return None
+    elif status != 429 and not (server_errors and status >= 500):
+        return None
+
+    # RateLimitExceededError exposes the parsed headers; older atproto only has the raw response
+    retry_after = getattr(e, "retry_after", None)
+    reset_at = getattr(e, "reset_at", None)
+    headers = {k.lower(): v for k, v in (getattr(response, "headers", None) or {}).items()}
+    if retry_after is None:
+        retry_after = headers.get("retry-after")
+    if reset_at is None and status == 429:
+        reset_at = headers.get("ratelimit-reset")
+    delay = None
+    try:
+        if isinstance(retry_after, datetime):
+            delay = retry_after.timestamp() - time.time()
+        elif retry_after is not None:
+            delay = float(retry_after)
+        elif isinstance(reset_at, datetime):
+            delay = reset_at.timestamp() - time.time()
+        elif reset_at is not None:
+            delay = float(reset_at) - time.time()
+    except (TypeError, ValueError):
+        delay = None
+    if delay is not None:
+        # the server asked for this wait; give up rather than sleep past the limit
+        if delay > RETRY_MAX_DELAY:
+            return None
+        return max(0.0, delay)
+    return min(RETRY_MAX_DELAY, 2 ** attempt + random.uniform(0, 1))
+
+def call_with_retry(fn, *args, server_errors: bool = True, **kwargs):
+    """Call an XRPC method, backing off on 429s and (if server_errors) 5xx/network failures.
+
+    Record writes pass server_errors=False: a timed-out create may still have been applied.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        # 429s and most 5xx arrive as RequestException (RateLimitExceededError for 429),
+        # transport failures as NetworkError; retry_delay decides by status
+        except (NetworkError, InvokeTimeoutError, RequestException) as e:
+            delay = retry_delay(e, attempt, server_errors)
+            if delay is None or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            log(f"⏳ Retry in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+# Python 3.11+ parses the trailing "Z" of bsky timestamps natively
+ISO_HANDLES_Z = sys.version_info >= (3, 11)
+
+def parse_iso(val: str) -> Optional[datetime]:
+    try:
+        if not ISO_HANDLES_Z and val.endswith("Z"):
+            val = val[:-1] + "+00:00"
+        dt = datetime.fromisoformat(val)
+    except Exception:
+        return None
+    # the lexicon requires an offset; read a missing one as UTC so comparisons with cutoff never raise
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def parse_time(record: Dict, post: Dict) -> Optional[datetime]:
+    # post records carry createdAt; only fall back to scanning other fields without it
+    dt = parse_iso(record.get("createdAt"))
+    if dt:
+        return dt
+    for key in ["indexedAt", "timestamp"]:
+        val = record.get(key) or post.get(key)
         if val:
-            try:
-                return datetime.fromisoformat(val.replace("Z", "+00:00"))
-            except Exception:
-                continue
+            dt = parse_iso(val)
+            if dt:
+                return dt
     return None
 
 def load_repost_log(path: str) -> Set[str]:
     if not os.path.exists(path):
         return set()
     with open(path, "r", encoding="utf-8") as f:
-        return {line.strip() for line in f if line.strip()}
-
-def save_repost_log(path: str, uris: Set[str]) -> None:
-    with open(path, "w", encoding="utf-8") as f:
-        for uri in sorted(uris):
-            f.write(uri + "\n")
-
-def has_media(record) -> bool:
-    embed = getattr(record, "embed", None)
-    if not embed:
-        return False
-    if getattr(embed, "images", None):
-        return True
-    if getattr(embed, "video", None):
-        return True
-    return False
-
-def is_quote_post(record) -> bool:
-    embed = getattr(record, "embed", None)
-    if not embed:
-        return False
-    return bool(getattr(embed, "record", None) or getattr(embed, "recordWithMedia", None))
+        uris = set(map(str.strip, f))
+    uris.discard("")
+    return uris
+
+def open_repost_log(path: str) -> TextIO:
+    """Open the repost log for appending, so each run only writes its new URIs.
+
+    Line-buffered: every URI hits the file right after its repost, so a killed run
+    does not repost it again next time.
+    """
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    f = open(path, "a", encoding="utf-8", buffering=1)
+    if needs_newline:
+        f.write("\n")
+    return f
+
+def has_media(embed: Dict) -> bool:
+    return bool(embed.get("images") or embed.get("video"))
+
+def is_quote_post(embed: Dict) -> bool:
+    # app.bsky.embed.record and app.bsky.embed.recordWithMedia both carry "record"
+    return bool(embed.get("record"))
 
 # ================== URI NORMALIZERS ==================
 
-FEED_URL_RE = re.compile(r"https://bsky.app/profile/([^/]+)/feed/([^/?#]+)", re.I)
-LIST_URL_RE = re.compile(r"https://bsky.app/profile/([^/]+)/lists/([^/?#]+)", re.I)
+AT_URI_PREFIXES = ("at://did:plc:", "at://did:web:")
+FEED_URL_RE = re.compile(r"https?://(?:www\.)?bsky\.app/profile/([^/?#]+)/feed/([^/?#]+)/?(?:[?#].*)?", re.I)
+LIST_URL_RE = re.compile(r"https?://(?:www\.)?bsky\.app/profile/([^/?#]+)/lists/([^/?#]+)/?(?:[?#].*)?", re.I)
 
+# feeds and stoplists are often hosted by the same curator
+@lru_cache(maxsize=64)
 def resolve_handle_to_did(client: Client, actor: str) -> Optional[str]:
     if actor.startswith("did:"):
         return actor
     try:
-        out = client.com.atproto.identity.resolve_handle({"handle": actor})
+        out = call_with_retry(client.com.atproto.identity.resolve_handle, {"handle": actor})
         return getattr(out, "did", None)
     except Exception:
         return None
@@ -78,9 +176,9 @@ def resolve_handle_to_did(client: Client, actor: str) -> Optional[str]:
 def normalize_feed_uri(client: Client, link: str) -> Optional[str]:
     if not link:
         return None
-    if link.startswith("at://"):
+    if link.startswith(AT_URI_PREFIXES):
         return link
-    m = FEED_URL_RE.match(link)
+    m = FEED_URL_RE.fullmatch(link.strip())
     if not m:
         return None
     did = resolve_handle_to_did(client, m.group(1))
@@ -91,9 +189,9 @@ def normalize_feed_uri(client: Client, link: str) -> Optional[str]:
 def normalize_list_uri(client: Client, link: str) -> Optional[str]:
     if not link:
         return None
-    if link.startswith("at://"):
+    if link.startswith(AT_URI_PREFIXES):
         return link
-    m = LIST_URL_RE.match(link)
+    m = LIST_URL_RE.fullmatch(link.strip())
     if not m:
         return None
     did = resolve_handle_to_did(client, m.group(1))
@@ -101,46 +199,132 @@ def normalize_list_uri(client: Client, link: str) -> Optional[str]:
         return None
     return f"at://{did}/app.bsky.graph.list/{m.group(2)}"
 
+def normalize_links(client: Client, links: List[str], normalize, kind: str) -> List[str]:
+    """Normalize the configured links, logging every one that could not be turned into an at:// URI."""
+    uris = []
+    for link in links:
+        if not link:
+            continue
+        uri = normalize(client, link)
+        if uri:
+            uris.append(uri)
+        else:
+            log(f"⚠️ Skipping {kind} link (could not normalize): {link}")
+    return uris
+
 # ================== FETCHERS ==================
 
-def fetch_feed_items(client: Client, feed_uri: str) -> List:
-    items, cursor = [], None
-    while True:
-        params = {"feed": feed_uri, "limit": 100}
-        if cursor:
-            params["cursor"] = cursor
-        out = client.app.bsky.feed.get_feed(params)
-        batch = getattr(out, "feed", []) or []
-        items.extend(batch)
-        cursor = getattr(out, "cursor", None)
-        if not cursor or len(items) >= FEED_MAX_ITEMS:
-            break
-    return items[:FEED_MAX_ITEMS]
+def fetch_feed_page(client: Client, feed_uri: str, cursor: Optional[str]) -> Dict:
+    """Raw getFeed JSON; skipping atproto's model parsing saves most of the per-page CPU."""
+    params = models.AppBskyFeedGetFeed.Params(feed=feed_uri, limit=100, cursor=cursor)
+    return call_with_retry(client.invoke_query, "app.bsky.feed.getFeed", params).content or {}
+
+def page_is_stale(batch: List, cutoff: datetime) -> bool:
+    """True when every post on the page was created before cutoff."""
+    for item in batch:
+        post = item["post"]
+        created_dt = parse_time(post["record"], post)
+        if created_dt and created_dt >= cutoff:
+            return False
+    return bool(batch)
+
+def iter_feed_pages(client: Client, feed_uri: str, cutoff: Optional[datetime] = None) -> Iterator[List]:
+    """Yield feed pages up to FEED_MAX_ITEMS, requesting page K+1 while the caller handles page K.
+
+    With a cutoff, pagination stops after the first page holding nothing newer than it.
+    """
+    remaining = FEED_MAX_ITEMS
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        pending = ex.submit(fetch_feed_page, client, feed_uri, None)
+        while pending is not None:
+            out = pending.result()
+            batch = (out.get("feed") or [])[:remaining]
+            remaining -= len(batch)
+            cursor = out.get("cursor")
+            pending = None
+            if cursor and remaining > 0 and not (cutoff and page_is_stale(batch, cutoff)):
+                pending = ex.submit(fetch_feed_page, client, feed_uri, cursor)
+            yield batch
 
 def fetch_list_members(client: Client, list_uri: str) -> List[str]:
     members, cursor = [], None
-    while True:
-        params = {"list": list_uri, "limit": 100}
+    while len(members) < LIST_MEMBER_LIMIT:
+        # only ask for what is still missing, so the last page stays small
+        params = {"list": list_uri, "limit": min(100, LIST_MEMBER_LIMIT - len(members))}
         if cursor:
             params["cursor"] = cursor
-        out = client.app.bsky.graph.get_list(params)
+        out = call_with_retry(client.app.bsky.graph.get_list, params)
         for it in getattr(out, "items", []) or []:
             subj = getattr(it, "subject", None)
             if subj and getattr(subj, "did", None):
                 members.append(subj.did)
-            if len(members) >= LIST_MEMBER_LIMIT:
-                return members[:LIST_MEMBER_LIMIT]
         cursor = getattr(out, "cursor", None)
         if not cursor:
             break
     return members[:LIST_MEMBER_LIMIT]
 
-def fetch_author_posts(client: Client, actor: str) -> List:
-    try:
-        out = client.app.bsky.feed.get_author_feed({"actor": actor, "limit": AUTHOR_POSTS_PER_MEMBER})
-        return getattr(out, "feed", []) or []
-    except Exception:
-        return []
+def fetch_following(client: Client, dids: List[str]) -> Dict[str, bool]:
+    """Map each did to whether we already follow it, 25 actors per getProfiles call."""
+    following = {}
+    for i in range(0, len(dids), 25):
+        try:
+            out = call_with_retry(client.app.bsky.actor.get_profiles, {"actors": dids[i:i + 25]})
+        except Exception as e:
+            log(f"⚠️ Profile lookup error: {e}")
+            continue
+        for profile in getattr(out, "profiles", []) or []:
+            following[profile.did] = bool(getattr(profile.viewer, "following", None))
+    return following
+
+def collect_feed_candidates(client: Client, feed_uri: str, done: Set[str], stop_dids: Set[str],
+                            cutoff: datetime, seen: Set[str]) -> List[Candidate]:
+    """Filter a feed down to repost candidates, skipping URIs already seen in other feeds."""
+    candidates = []
+    candidates_append = candidates.append
+    done_contains = done.__contains__
+    seen_contains = seen.__contains__
+    seen_add = seen.add
+    stop_contains = stop_dids.__contains__
+    for page in iter_feed_pages(client, feed_uri, cutoff):
+        for item in page:
+            # reason belongs to the feed item, not the post: a post carried as a
+            # repost here may be an original in another feed, so check it before seen
+            if item.get("reason") is not None:
+                continue
+            post = item["post"]
+            uri = post["uri"]
+            if seen_contains(uri) or done_contains(uri):
+                continue
+            seen_add(uri)
+            record = post["record"]
+
+            # cheapest checks first; most feed items are dropped here
+            if record.get("reply"):
+                continue
+            embed = record.get("embed")
+            if not embed or is_quote_post(embed) or not has_media(embed):
+                continue
+
+            author_did = post["author"]["did"]
+            if stop_contains(author_did):
+                continue
+
+            created_dt = parse_time(record, post)
+            if not created_dt or created_dt < cutoff:
+                continue
+
+            candidates_append(Candidate(created_dt, uri, post["cid"], author_did))
+    return candidates
+
+def fetch_concurrently(client: Client, fetch, uris: List[str]):
+    """Run fetch(client, uri) for every uri in parallel, yielding (uri, result) as they finish."""
+    if not uris:
+        return
+    # the client's httpx session is thread-safe, so all workers share it
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(uris)))) as ex:
+        futures = {ex.submit(fetch, client, uri): uri for uri in uris}
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
 
 # ================== MAIN ==================
 
@@ -161,99 +345,97 @@ def main():
 
     # FEEDS
     feed_links = [os.getenv(f"FEED_{i}_LINK", "") for i in range(1, 11)]
-    feeds = [normalize_feed_uri(client, f) for f in feed_links if f]
+    feeds = normalize_links(client, feed_links, normalize_feed_uri, "feed")
 
     # STOPLISTS
     stop_links = [os.getenv(f"STOPLIST_{i}_LINK", "") for i in range(1, 11)]
+    stop_lists = normalize_links(client, stop_links, normalize_list_uri, "stoplist")
     stop_dids = set()
-    for link in stop_links:
-        uri = normalize_list_uri(client, link)
-        if uri:
-            stop_dids.update(fetch_list_members(client, uri))
+    for _, members in fetch_concurrently(client, fetch_list_members, stop_lists):
+        stop_dids.update(members)
 
-    candidates = []
-
-    for feed_uri in feeds:
-        log(f"📥 Feed: {feed_uri}")
-        for item in fetch_feed_items(client, feed_uri):
-            post = item.post
-            record = post.record
-            uri = post.uri
-            cid = post.cid
+    # CANDIDATES
+    # shared by the feed workers; only post-level checks follow the seen test, so
+    # whichever feed reaches a post first judges it the same way the others would.
+    # A rare race lets a duplicate through, which the done check in the repost loop catches
+    seen_uri = set()
 
-            if uri in done:
-                continue
-            if hasattr(item, "reason") and item.reason is not None:
-                continue
-            if is_quote_post(record):
-                continue
-            if not has_media(record):
-                continue
-            if getattr(record, "reply", None):
-                continue
+    def collect(c: Client, feed_uri: str) -> List[Candidate]:
+        return collect_feed_candidates(c, feed_uri, done, stop_dids, cutoff, seen_uri)
 
-            created_dt = parse_time(record, post)
-            if not created_dt or created_dt < cutoff:
-                continue
-
-            author_did = getattr(post.author, "did", None)
-            if author_did in stop_dids:
-                continue
+    candidates = []
+    for feed_uri, found in fetch_concurrently(client, collect, feeds):
+        log(f"📥 Feed: {feed_uri} ({len(found)} candidates)")
+        candidates.extend(found)
 
-            candidates.append({
-                "uri": uri,
-                "cid": cid,
-                "author": author_did,
-                "created": created_dt
-            })
+    # oldest first; only the popped prefix is ever ordered
+    heapq.heapify(candidates)
 
-    candidates.sort(key=lambda x: x["created"])
+    # authors missing from the map (lookup failed) are never followed
+    following = {}
+    if FOLLOW_ON_REPOST:
+        following = fetch_following(client, list({c.author for c in candidates if c.author}))
 
     reposted = 0
     per_user = {}
+    my_did = client.me.did
+    last_post = None
 
-    for c in candidates:
-        if reposted >= MAX_PER_RUN:
-            break
+    with open_repost_log(REPOST_LOG_FILE) as repost_log:
+        while candidates and reposted < MAX_PER_RUN:
+            c = heapq.heappop(candidates)
 
-        au = c["author"]
-        per_user.setdefault(au, 0)
-        if per_user[au] >= MAX_PER_USER:
-            continue
+            # the same post can come in through several feeds
+            if c.uri in done:
+                continue
 
-        try:
-            client.app.bsky.feed.repost.create(
-                repo=client.me.did,
-                record={
-                    "subject": {"uri": c["uri"], "cid": c["cid"]},
-                    "createdAt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                },
-            )
-            done.add(c["uri"])
-            per_user[au] += 1
-            reposted += 1
-
-            if FOLLOW_ON_REPOST:
-                try:
-                    profile = client.app.bsky.actor.get_profile({"actor": au})
-                    if not getattr(profile.viewer, "following", None):
-                        client.app.bsky.graph.follow.create(
-                            repo=client.me.did,
+            au = c.author
+            per_user.setdefault(au, 0)
+            if per_user[au] >= MAX_PER_USER:
+                continue
+
+            # keep reposts POST_DELAY_SECONDS apart, counting time spent in the calls themselves
+            if last_post is not None:
+                wait = POST_DELAY_SECONDS - (time.monotonic() - last_post)
+                if wait > 0:
+                    time.sleep(wait)
+            last_post = time.monotonic()
+
+            ts = now_z()
+            try:
+                call_with_retry(
+                    client.app.bsky.feed.repost.create,
+                    server_errors=False,
+                    repo=my_did,
+                    record={
+                        "subject": {"uri": c.uri, "cid": c.cid},
+                        "createdAt": ts,
+                    },
+                )
+                done.add(c.uri)
+                repost_log.write(c.uri + "\n")
+                per_user[au] += 1
+                reposted += 1
+
+                if FOLLOW_ON_REPOST and following.get(au) is False:
+                    try:
+                        call_with_retry(
+                            client.app.bsky.graph.follow.create,
+                            server_errors=False,
+                            repo=my_did,
                             record={
                                 "subject": au,
-                                "createdAt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                "createdAt": ts,
                             },
                         )
-                except Exception:
-                    pass
-
-            time.sleep(POST_DELAY_SECONDS)
+                        following[au] = True
+                    except Exception:
+                        pass
 
-        except Exception as e:
-            log(f"⚠️ Repost error: {e}")
-            time.sleep(5)
+            except Exception as e:
+                log(f"⚠️ Repost error: {e}")
+                time.sleep(5)
 
-    save_repost_log(REPOST_LOG_FILE, done)
     log(f"🔥 Done — {reposted} reposts")
 
 if __name__ == "__main__":